@@ -407,6 +407,12 @@ def create_app(path, app=None, production=False):
         try:
             state_name = storage.user_retrieve_state(uid).state
         except FileNotFoundError:
+            # Links sent before the uids were migrated.
+            new_uid = storage.migrated_uid(uid)
+            if new_uid is not None:
+                return flask.redirect(
+                    url_for("view_current_state", uid=new_uid, form_number=form_number)
+                )
             return app_render_template("message.html", message=common.MSG_INVALID_UID)
 
         state = hobj.states[state_name]
@@ -0,0 +1,117 @@
+"""
+    hymie.cache
+    ~~~~~~~~~~~
+
+    In-memory caches.
+
+    :copyright: 2020 by hymie Authors, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import collections
+import threading
+
+#: Number of rows (independent hashes) of the frequency sketch.
+_SKETCH_DEPTH = 4
+
+#: Maximum value of a sketch counter (4 bits).
+_SKETCH_MAX = 15
+
+#: Translation table to halve all counters of a row at once.
+_HALVE = bytes(i >> 1 for i in range(256))
+
+
+class TinyLFUCache:
+    """A bounded mapping with LRU eviction and TinyLFU admission.
+
+    While there is room, every key is stored. When the cache is full, a new key
+    is only admitted if it has been requested more often than the least recently
+    used entry, which is then evicted. This keeps the frequently used entries
+    when a long tail of keys is accessed once (e.g. iterating over all users).
+
+    Request frequencies are estimated with a Count-Min sketch of small counters
+    which are halved periodically so that old popularity fades.
+
+    Parameters
+    ----------
+    maxsize : int
+        maximum number of entries.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # Power of 2 with at least 4 counters per entry.
+        self._width = 1 << max(6, (4 * maxsize - 1).bit_length())
+        self._mask = self._width - 1
+        self._sketch = [bytearray(self._width) for _ in range(_SKETCH_DEPTH)]
+        self._sample_size = 10 * maxsize
+        self._samples = 0
+
+    def _indices(self, key):
+        h = hash(key)
+        h2 = (h >> 32) | 1
+        mask = self._mask
+        return [(h + i * h2) & mask for i in range(_SKETCH_DEPTH)]
+
+    def _increment(self, key):
+        for row, ndx in zip(self._sketch, self._indices(key)):
+            if row[ndx] < _SKETCH_MAX:
+                row[ndx] += 1
+
+        self._samples += 1
+        if self._samples >= self._sample_size:
+            self._samples = 0
+            for row in self._sketch:
+                row[:] = row.translate(_HALVE)
+
+    def frequency(self, key):
+        """Estimated number of recent requests for key.
+        """
+        return min(row[ndx] for row, ndx in zip(self._sketch, self._indices(key)))
+
+    def __getitem__(self, key):
+        with self._lock:
+            self._increment(key)
+            value = self._data[key]
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            data = self._data
+            if key in data:
+                data[key] = value
+                data.move_to_end(key)
+                return
+
+            if len(data) >= self.maxsize:
+                victim = next(iter(data))
+                if self.frequency(key) <= self.frequency(victim):
+                    return
+                del data[victim]
+
+            data[key] = value
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -15,6 +15,7 @@ import re
 from flask import flash, url_for
 from flask_wtf import FlaskForm
 from jinja2 import BaseLoader, Environment, nodes
+from markdown.extensions.meta import BEGIN_RE, END_RE, META_MORE_RE, META_RE
 from wtforms import StringField, SubmitField
 from wtforms import validators as v
 
@@ -99,6 +100,44 @@ def build_links(meta, uid, storage, _view_link_for=None, _view_admin_link_for=No
     return out
 
 
+def split_meta(text):
+    """Split the attributes header from the body of a template.
+
+    The header follows the syntax of the Markdown meta extension and
+    the attributes are returned in the same way (lowercase keys, list of values).
+
+    Parameters
+    ----------
+    text : str
+
+    Returns
+    -------
+    dict, str
+        attributes, body
+    """
+    lines = text.split("\n")
+    meta = {}
+    key = None
+    if lines and BEGIN_RE.match(lines[0]):
+        lines.pop(0)
+    while lines:
+        line = lines.pop(0)
+        if line.strip() == "" or END_RE.match(line):
+            break
+        m1 = META_RE.match(line)
+        if m1:
+            key = m1.group("key").lower().strip()
+            meta.setdefault(key, []).append(m1.group("value").strip())
+            continue
+        m2 = META_MORE_RE.match(line)
+        if m2 and key:
+            meta[key].append(m2.group("value").strip())
+        else:
+            lines.insert(0, line)
+            break
+    return meta, "\n".join(lines)
+
+
 def recurse_ga(node):
     if isinstance(node, nodes.Name):
         return (node.name,)
@@ -8,11 +8,17 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import functools
+import hashlib
+import json
+import os
 import pathlib
 from datetime import datetime
 from typing import Dict
 
+import jinja2
+import markdown
+import mdform
+import wtforms
 from flask import Flask, url_for
 from flask_emails import Message
 from flask_uploads import configure_uploads
@@ -24,6 +30,81 @@ from .common import BASE_JINJA_ENV, SmartLoader, extract_jinja2_variables, logge
 from .forms import generate_form_cls, generate_read_only_form_cls
 from .storage import Storage
 
+# Prefixes of the template variables that refer to form fields.
+_FORM_PREFIX = "form."
+_FORM_PREFIX_LEN = len(_FORM_PREFIX)
+_PREVIOUS_PREFIX = "previous."
+_PREVIOUS_PREFIX_LEN = len(_PREVIOUS_PREFIX)
+_PREFIXES = (_FORM_PREFIX, _PREVIOUS_PREFIX)
+
+#: Name of the Hymie method checking each action type (matched on the exact class).
+_ACTION_INTEGRITY = {
+    schema.ActionEmailForm: "integrity_email_form",
+    schema.ActionEmail: "integrity_email",
+}
+
+
+def _special_email(email):
+    """Return the special value ("self" or "user") that an e-mail field
+    refers to, or None if it is a literal address.
+    """
+    _email = email.strip().lower()
+    if _email in ("self", "user"):
+        return _email
+    return None
+
+
+def _iter_files(folder, suffix=""):
+    """Yield the path of all files within a folder and its subfolders.
+
+    Parameters
+    ----------
+    folder : str or pathlib.Path
+    suffix : str
+        only files ending with it are yielded.
+
+    Yields
+    ------
+    str
+    """
+    try:
+        it = os.scandir(folder)
+    except FileNotFoundError:
+        return
+    with it:
+        for entry in it:
+            # Symlinks to folders are not followed, they might form a cycle.
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_files(entry.path, suffix)
+            elif entry.name.endswith(suffix) and not entry.is_dir():
+                yield entry.path
+
+
+def _read_template(path):
+    """Read a Markdown template and convert it to html.
+
+    Templates with an html extension are used as they are,
+    only the attributes header is parsed.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+
+    Returns
+    -------
+    dict, str
+        attributes of the template, html
+    """
+    with path.open(mode="r", encoding="utf-8") as fi:
+        text = fi.read()
+
+    if path.suffix.lower() in (".html", ".htm"):
+        return common.split_meta(text)
+
+    md = Markdown(extensions=["meta"])
+    html = md.convert(text)
+    return md.Meta, html
+
 
 class FakeMessage(Message):
     """A drop-in replacement for e-mail Message that prints the mail
@@ -72,11 +153,14 @@ class Hymie:
         )
 
         hymie_mtime = max(
-            [f.stat().st_mtime for f in pathlib.Path(__file__).parent.rglob("*")]
+            os.stat(f).st_mtime for f in _iter_files(os.path.dirname(__file__))
         )
 
         logger.info(f"Loaded app definition from {files}")
 
+        #: Configuration files from which the app was loaded.
+        self.config_files = files
+
         content: schema.Root = schema.Root.from_filenames(files)
 
         logger.info(f"Loaded app")
@@ -99,7 +183,11 @@ class Hymie:
             ),
         )
 
-        self.storage = Storage(self.config.storage.path, self.config.storage.salt)
+        self.storage = Storage(
+            self.config.storage.path,
+            self.config.storage.salt,
+            self.config.storage.kdf_iterations,
+        )
         self.subject_prefix = self.config.email.subject.strip() + " "
 
         if self.config.email.debug:
@@ -108,10 +196,26 @@ class Hymie:
         else:
             self.Message = Message
 
+        # Parsed templates, keyed by the arguments of get_email, get_form and get_page.
+        self._email_cache = {}
+        self._form_cache = {}
+        self._page_cache = {}
+
         self.friendly_user_id_getter = SmartLoader(
             self.storage, self.metadata.friendly_user_id
         )
 
+        # Resolve once the special values of all e-mail fields in the
+        # configuration so that convert_email is a single lookup when sending.
+        self._special_emails = {}
+        for form in self.forms.values():
+            for action in form.on_submit:
+                if not isinstance(action, schema.ActionBaseEmail):
+                    continue
+                for email in (action.destination, action.cc, action.bcc):
+                    if email is not None:
+                        self._special_emails[email] = _special_email(email)
+
     def set_config(self, app):
         cfg = self.config
         app.config["EMAIL_HOST"] = cfg.email.host
@@ -173,11 +277,10 @@ class Hymie:
                 except Exception as e:
                     logger.exception(f"While yield_users_state: {e}")
 
-    def yield_user_index_for(self, uid):
+    def yield_user_index_for(self, uid, limit=None):
         # Timestamp, endpoint
-        yield from self.storage.user_retrieve_index(uid)
+        yield from self.storage.user_retrieve_index(uid, limit)
 
-    @functools.lru_cache(maxsize=64)
     def get_email(self, template_filename):
         """Get e-mail template from template name
 
@@ -192,21 +295,23 @@ class Hymie:
             attributes of the template, e-mail as jinja2 template, variables (with modifiers) in the template
         """
 
-        mdfile = self.path.joinpath("emails", template_filename)
+        try:
+            return self._email_cache[template_filename]
+        except KeyError:
+            pass
 
-        with mdfile.open(mode="r", encoding="utf-8") as fi:
-            md = Markdown(extensions=["meta"])
-            html = md.convert(fi.read())
+        meta, html = _read_template(self.path.joinpath("emails", template_filename))
 
         variables = extract_jinja2_variables(html)
 
-        return md.Meta, BASE_JINJA_ENV.from_string(html), variables
+        out = meta, BASE_JINJA_ENV.from_string(html), variables
+        self._email_cache[template_filename] = out
+        return out
 
     def get_form_by_name(self, name, app, read_only=False, extends="form.html"):
         template = self.forms[name].template or (name + ".md")
         return self.get_form(template, app, read_only, extends)
 
-    @functools.lru_cache(maxsize=64)
     def get_form(self, template_filename, app, read_only=False, extends="form.html"):
         """Get form template from template name.
 
@@ -228,6 +333,12 @@ class Hymie:
             form attributes, form as jinja2 template, form object, jinja2 variables
         """
 
+        key = (template_filename, app, read_only, extends)
+        try:
+            return self._form_cache[key]
+        except KeyError:
+            pass
+
         mdfile = self.path.joinpath("forms", template_filename)
 
         with mdfile.open(mode="r", encoding="utf-8") as fi:
@@ -247,22 +358,17 @@ class Hymie:
         tmpl += html
         tmpl += "{% endblock %})"
 
-        if app:
-            return (
-                md.Meta,
-                app.jinja_env.from_string(tmpl),
-                wtform,
-                extract_jinja2_variables(html),
-            )
+        jinja_env = app.jinja_env if app else BASE_JINJA_ENV
 
-        return (
+        out = (
             md.Meta,
-            BASE_JINJA_ENV.from_string(tmpl),
+            jinja_env.from_string(tmpl),
             wtform,
             extract_jinja2_variables(html),
         )
+        self._form_cache[key] = out
+        return out
 
-    @functools.lru_cache(maxsize=64)
     def get_page(self, template_filename, app, extends="simple.html"):
         """Get page template from template name.
 
@@ -281,11 +387,14 @@ class Hymie:
         dict, jinja2.Template
             form attributes, form as jinja2 template
         """
-        mdfile = self.path.joinpath("pages", template_filename)
 
-        with mdfile.open(mode="r", encoding="utf-8") as fi:
-            md = Markdown(extensions=["meta"])
-            html = md.convert(fi.read())
+        key = (template_filename, app, extends)
+        try:
+            return self._page_cache[key]
+        except KeyError:
+            pass
+
+        meta, html = _read_template(self.path.joinpath("pages", template_filename))
 
         tmpl = ""
         if tmpl:
@@ -300,14 +409,11 @@ class Hymie:
             + "{% endblock %}"
         )
 
-        if app:
-            return (
-                md.Meta,
-                app.jinja_env.from_string(tmpl),
-                extract_jinja2_variables(html),
-            )
+        jinja_env = app.jinja_env if app else BASE_JINJA_ENV
 
-        return md.Meta, BASE_JINJA_ENV.from_string(tmpl), extract_jinja2_variables(html)
+        out = meta, jinja_env.from_string(tmpl), extract_jinja2_variables(html)
+        self._page_cache[key] = out
+        return out
 
     def convert_email(self, email, uid):
         """Convert e-mail field to e-mail address.
@@ -328,14 +434,19 @@ class Hymie:
         if email is None:
             return
 
-        _email = email.strip().lower()
-        if _email == "self":
+        try:
+            special = self._special_emails[email]
+        except KeyError:
+            # Not in the configuration (e.g. an action built on the fly).
+            special = self._special_emails[email] = _special_email(email)
+
+        if special is None:
+            return email
+        elif special == "self":
             return self.config.email.address
-        elif _email == "user":
+        else:
             return self.storage.user_retrieve_email(uid)
 
-        return email
-
     def send(self, destination, subject, html, cc=None, bcc=None):
         """Send and e-mail.
 
@@ -465,14 +576,18 @@ class Hymie:
     # before it is served.
 
     def check_prefixed_variable(self, app, form_name, variable, known_links):
-        if form_name and variable.startswith("form."):
-            return self.check_variable(app, form_name + "." + variable[len("form.") :])
-        elif variable.startswith("previous."):
-            return self.check_variable(app, variable[len("previous.") :])
-        elif variable not in known_links:
+        if variable.startswith(_PREFIXES):
+            if variable.startswith(_PREVIOUS_PREFIX):
+                return self.check_variable(app, variable[_PREVIOUS_PREFIX_LEN:])
+            elif form_name:
+                return self.check_variable(
+                    app, form_name + "." + variable[_FORM_PREFIX_LEN:]
+                )
+
+        if variable not in known_links:
             return self.check_variable(app, variable)
-        else:
-            return True
+
+        return True
 
     def integrity_action_base(self, name, app, action):
         errs = []
@@ -561,21 +676,24 @@ class Hymie:
 
     def check_variable(self, app, form_variable):
 
+        # Bound locally as this is called for every variable in every template.
+        template_vars = self.template_vars
+        forms = self.forms
+
         if form_variable.startswith("wtf"):
             return True
 
         if form_variable in ("link", "form", "previous", "user_email"):
             return True
 
-        if form_variable in self.template_vars:
+        if form_variable in template_vars:
             return True
 
-        if form_variable in self.forms:
+        if form_variable in forms:
             return True
 
-        try:
-            form_name, attr_name = form_variable.split(".")
-        except Exception:
+        form_name, sep, attr_name = form_variable.partition(".")
+        if not sep or "." in attr_name:
             raise Exception(f"Could not split '{form_variable}'")
 
         try:
@@ -616,13 +734,65 @@ class Hymie:
 
         return errs
 
-    def integrity_check(self, app):
+    def _integrity_digest(self):
+        """Return a hash of the content of all files checked by integrity_check.
+
+        This includes the configuration files, the templates of the app,
+        the hymie package (code and base templates) and the version of the
+        packages used to generate the forms and render the templates.
+        """
+        files = [str(f) for f in self.config_files]
+        for folder in ("forms", "emails", "pages"):
+            files.extend(_iter_files(self.path.joinpath(folder)))
+        hymie_path = os.path.dirname(__file__)
+        files.extend(_iter_files(hymie_path, ".py"))
+        files.extend(_iter_files(os.path.join(hymie_path, "templates"), ".html"))
+
+        h = hashlib.blake2b()
+        for module in (jinja2, markdown, mdform, wtforms):
+            version = getattr(module, "__version__", "")
+            h.update(f"{module.__name__} {version}\n".encode("utf-8"))
+        for f in sorted(files):
+            h.update(f.encode("utf-8"))
+            with open(f, "rb") as fi:
+                h.update(fi.read())
+        return h.hexdigest()
+
+    def integrity_check(self, app, use_cache=True):
+        """Check the app for possible logic errors.
+
+        Parameters
+        ----------
+        app : flask.Flask
+        use_cache : bool
+            If True, the check is skipped when none of the input files
+            have changed since the last check that passed.
+        """
+
+        cache_file = self.path.joinpath(".hymie_integrity_cache.json")
+
+        if use_cache:
+            digest = self._integrity_digest()
+            try:
+                cached = json.loads(cache_file.read_bytes())
+                if cached.get("passed") and cached.get("hash") == digest:
+                    logger.info("Input files unchanged, skipping integrity check.")
+                    return
+            except (OSError, ValueError):
+                pass
+
+        # Bound locally as these are used within the loops over states and forms.
+        states = self.states
+        forms = self.forms
+        check_str_template = self.check_str_template
+        check_prefixed_variable = self.check_prefixed_variable
+        integrity_page_check = self.integrity_page_check
 
         errs = []
         warns = []
 
         first = self.metadata.first_state
-        if first in self.states:
+        if first in states:
             logger.debug(f"first_state is '{first}'")
         else:
             errs.append(f"first_state not found: '{first}'")
@@ -630,10 +800,10 @@ class Hymie:
         if self.metadata.friendly_user_id:
             errs.extend(
                 "In friendly_user_id, " + err
-                for err in self.check_str_template(app, self.metadata.friendly_user_id)
+                for err in check_str_template(app, self.metadata.friendly_user_id)
             )
 
-        for name, state in self.states.items():
+        for name, state in states.items():
 
             err_prefix = f"In state '{name}',"
 
@@ -645,14 +815,14 @@ class Hymie:
             if state.page_template:
                 errs.extend(
                     f"{err_prefix} " + s
-                    for s in self.integrity_page_check(
+                    for s in integrity_page_check(
                         app, state.page_template, state.page_render_kw
                     )
                 )
 
             for fis in state.forms + state.admin_forms:
 
-                if fis.form not in self.forms:
+                if fis.form not in forms:
                     errs.append(f"{err_prefix} the form {fis.form} is not in forms")
                     continue
 
@@ -660,23 +830,21 @@ class Hymie:
                     errs.extend(
                         (
                             f"{err_prefix} condition " + s
-                            for s in self.check_str_template(
-                                app, cne.condition, fis.form
-                            )
+                            for s in check_str_template(app, cne.condition, fis.form)
                         )
                     )
-                    if cne.next_state not in self.states:
+                    if cne.next_state not in states:
                         errs.append(
                             f"{err_prefix} conditional next_state points to an unknown state: {cne.next_state}"
                         )
 
                 next_state = fis.next_state
-                if next_state and next_state not in self.states:
+                if next_state and next_state not in states:
                     errs.append(
                         f"{err_prefix} next_state points to an unknown state: {next_state}"
                     )
 
-        for name, form in self.forms.items():
+        for name, form in forms.items():
 
             err_prefix = f"In form '{name}',"
 
@@ -686,7 +854,7 @@ class Hymie:
             try:
                 _, tmpl, _, tmpl_vars = self.get_form_by_name(name, app)
                 tmp = (
-                    self.check_prefixed_variable(app, name, tmpl_var, ())
+                    check_prefixed_variable(app, name, tmpl_var, ())
                     for tmpl_var in tmpl_vars
                     if tmpl_var not in form.template_render_kw
                 )
@@ -704,24 +872,20 @@ class Hymie:
                 errs.append(f"{err_prefix} could not get form: {e}")
 
             for action in form.on_submit:
-                if isinstance(action, schema.ActionEmailForm):
-                    errs.extend(
-                        f"{err_prefix} " + s
-                        for s in self.integrity_email_form(name, app, action)
+                method_name = _ACTION_INTEGRITY.get(type(action))
+                if method_name is None:
+                    errs.append(
+                        f"{err_prefix} no integrity check defined for {action.__class__.__name__}"
                     )
-                elif isinstance(action, schema.ActionEmail):
+                else:
                     errs.extend(
                         f"{err_prefix} " + s
-                        for s in self.integrity_email(name, app, action)
-                    )
-                else:
-                    errs.append(
-                        f"{err_prefix} no integrity check defined for {action.__class__.__name__}"
+                        for s in getattr(self, method_name)(name, app, action)
                     )
 
             errs.extend(
                 f"{err_prefix} " + s
-                for s in self.integrity_page_check(
+                for s in integrity_page_check(
                     app, form.after_template, form.after_render_kw, name
                 )
             )
@@ -733,3 +897,10 @@ class Hymie:
 
         if errs:
             raise Exception("Integrity check not passed")
+
+        if use_cache:
+            try:
+                with cache_file.open("w", encoding="utf-8") as fo:
+                    json.dump(dict(hash=digest, passed=True), fo)
+            except OSError as e:
+                logger.warning(f"Could not write the integrity cache: {e}")
@@ -8,19 +8,30 @@
     :license: BSD, see LICENSE for more details.
 """
 
-
+import functools
 from typing import Dict, List
 
 from datastruct import DataStruct, validators
 from datastruct.ds import KeyDefinedValue
 
+#: Values accepted by SpecialEmail in addition to e-mail addresses.
+_SPECIAL_EMAILS = frozenset(("self", "user"))
+
+
+# The same few addresses are usually repeated across many actions.
+@functools.lru_cache(maxsize=256)
+def _validate_email(instance):
+    return validators.Email.validate(instance)
+
 
 class SpecialEmail(validators.Email):
     @classmethod
     def validate(cls, instance):
-        if instance in ("self", "user"):
+        if not isinstance(instance, str):
+            return False
+        if instance in _SPECIAL_EMAILS:
             return True
-        return super().validate(instance)
+        return _validate_email(instance)
 
 
 class Metadata(DataStruct):
@@ -53,6 +64,7 @@ class Secret(DataStruct):
 class Storage(DataStruct):
     path: str
     salt: str
+    kdf_iterations: int = None
 
 
 class Config(DataStruct):
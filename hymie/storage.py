@@ -9,16 +9,75 @@
 """
 
 import contextlib
+import datetime
 import functools
 import hashlib
-import json
+import heapq
+import operator
+import os
 import pathlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Tuple
 
-import arrow
-from flask import url_for
-from flask_uploads import UploadSet
+from flask import g, url_for
+
+from .cache import TinyLFUCache
+from .common import logger
+
+try:
+    from orjson import dumps as _json_dumps
+    from orjson import loads as _json_loads
+except ImportError:
+    import json
+
+    def _json_dumps(data):
+        return json.dumps(data).encode("utf-8")
+
+    _json_loads = json.loads
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows, updates are only serialized within the process.
+    fcntl = None
+
+#: Name of the file that records the most recent dated file of each endpoint.
+LATEST_INDEX = "_latest.json"
+
+#: Name of the file locked while updating the index of a user folder.
+LATEST_LOCK = "_latest.lock"
+
+#: Name of the plain text file with the e-mail of a user.
+EMAIL_FILE = "_email.txt"
+
+#: Name of the file with the number of PBKDF2 iterations used for the uid.
+KDF_ITERATIONS_FILE = "kdf_iterations.txt"
+
+#: Name of the file that records the uid renames of migrate_kdf_iterations.
+KDF_MIGRATION_FILE = "kdf_migration.json"
+
+#: Iterations for storages created before they were configurable.
+LEGACY_KDF_ITERATIONS = 100000
+
+#: Iterations for new storages. The salt is kept on the server, so the uid
+#: does not need the cost of a password hash.
+DEFAULT_KDF_ITERATIONS = 1000
+
+#: Coarsest modification time resolution expected from a filesystem (FAT).
+_MTIME_RESOLUTION_NS = 2_000_000_000
+
+#: Seconds after which a user folder without e-mail is no longer
+#: considered to be in the middle of a registration.
+_PENDING_FOLDER_TIMEOUT = 60
+
+#: Minimum number of files to be read in the thread pool.
+_PARALLEL_READS = 8
+
+#: Threads are only started when the pool is used.
+_read_executor = ThreadPoolExecutor(max_workers=8)
 
 
 def split_endpoint_timestamp(file):
@@ -26,7 +85,7 @@ def split_endpoint_timestamp(file):
 
     Parameters
     ----------
-    file : pathlib.Path
+    file : str or pathlib.Path
         Can be a dated file or a link.
 
     Returns
@@ -34,8 +93,45 @@ def split_endpoint_timestamp(file):
     str, str
         endpoint name and timestamp
     """
-    endpoint, date, time = file.resolve().stem.rsplit("_", 2)
-    return endpoint, date + "_" + time
+    file = os.fspath(file)
+    if os.path.islink(file):
+        # Only the name of the target is needed, a single readlink is enough.
+        file = os.readlink(file)
+    return _split_dated_name(os.path.basename(file))
+
+
+def _file_in(folder, name):
+    """Return the path of a file in a folder as a string.
+
+    Cheaper than building a pathlib.Path when it is only used to open the file.
+
+    Parameters
+    ----------
+    folder : str or pathlib.Path
+    name : str
+
+    Returns
+    -------
+    str
+    """
+    return f"{os.fspath(folder)}{os.sep}{name}"
+
+
+@functools.lru_cache(maxsize=4096)
+def _split_dated_name(name):
+    """Split the name of a dated file into the endpoint and timestamp part.
+
+    Parameters
+    ----------
+    name : str
+
+    Returns
+    -------
+    str, str
+        endpoint name and timestamp
+    """
+    endpoint, date, time_ = os.path.splitext(name)[0].rsplit("_", 2)
+    return endpoint, date + "_" + time_
 
 
 def datetime_to_timestamp(dt=None):
@@ -50,7 +146,11 @@ def datetime_to_timestamp(dt=None):
     str
     """
     if dt is None:
-        dt = arrow.now()
+        t = time.localtime()
+        return (
+            f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}_"
+            f"{t.tm_hour:02d}{t.tm_min:02d}{t.tm_sec:02d}"
+        )
     return dt.strftime("%Y%m%d_%H%M%S")
 
 
@@ -65,7 +165,17 @@ def timestamp_to_datetime(ts):
     -------
     arrow.Arrow
     """
-    return arrow.get(ts, "YYYYMMDD_HHmmss")
+    import arrow
+
+    # Fixed width YYYYmmdd_HHMMSS, slicing avoids arrow's format parser.
+    return arrow.Arrow(
+        int(ts[0:4]),
+        int(ts[4:6]),
+        int(ts[6:8]),
+        int(ts[9:11]),
+        int(ts[11:13]),
+        int(ts[13:15]),
+    )
 
 
 def pprint_timestamp(timestamp, locale="en_us"):
@@ -80,33 +190,126 @@ def pprint_timestamp(timestamp, locale="en_us"):
     -------
     str
     """
-    dt = timestamp_to_datetime(timestamp)
-    return dt.format(fmt="YYYY-MM-DD HH:mm") + " (%s) " % dt.humanize(locale=locale)
+    ts = timestamp
+    dt = timestamp_to_datetime(ts)
+    return (
+        f"{ts[0:4]}-{ts[4:6]}-{ts[6:8]} {ts[9:11]}:{ts[11:13]}"
+        f" ({dt.humanize(locale=locale)}) "
+    )
 
 
-def _retrieve(json_file):
+def _retrieve(json_file, endpoint_timestamp=None):
     """Read json file from disk into dict.
 
     In addition the to the actual content, the plain endpoint and timestamp are added.
 
     Parameters
     ----------
-    json_file : pathlib.Path
+    json_file : str or pathlib.Path
+    endpoint_timestamp : (str, str) or None
+        endpoint and timestamp of the file, if already known.
 
     Returns
     -------
     dict
     """
 
-    with json_file.open("r", encoding="utf-8") as fi:
-        content = json.load(fi)
+    with open(json_file, "rb") as fi:
+        content = _json_loads(fi.read())
 
-    endpoint, timestamp = split_endpoint_timestamp(json_file)
-    content["_hymie_endpoint"] = endpoint
-    content["_hymie_timestamp"] = timestamp
+    if endpoint_timestamp is None:
+        endpoint_timestamp = split_endpoint_timestamp(json_file)
+    content["_hymie_endpoint"], content["_hymie_timestamp"] = endpoint_timestamp
     return content
 
 
+def _retrieve_dated(folder, dated_names):
+    """Read several dated files of a folder.
+
+    Many files are read concurrently in a thread pool to overlap the disk
+    latency.
+
+    Parameters
+    ----------
+    folder : str or pathlib.Path
+    dated_names : dict
+        endpoint -> dated file name
+
+    Returns
+    -------
+    dict
+        endpoint -> content
+    """
+
+    def _read(dated_name):
+        return _retrieve(_file_in(folder, dated_name), _split_dated_name(dated_name))
+
+    if len(dated_names) < _PARALLEL_READS:
+        contents = map(_read, dated_names.values())
+    else:
+        contents = _read_executor.map(_read, dated_names.values())
+    return dict(zip(dated_names.keys(), contents))
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_formats(form_cls):
+    """Return the format to parse the stored value of each date and time
+    field of a form class.
+
+    Parameters
+    ----------
+    form_cls : type
+        FlaskForm derived class.
+
+    Returns
+    -------
+    dict
+        field name -> strptime format
+    """
+    out = {}
+    for name in dir(form_cls):
+        field_class = getattr(getattr(form_cls, name, None), "field_class", None)
+        if field_class is None:
+            continue
+        if field_class.__name__ == "DateField":
+            out[name] = "%d/%m/%y"
+        elif field_class.__name__ == "TimeField":
+            out[name] = "%H:%M"
+    return out
+
+
+#: Stands for the fileid in the url of uploaded files.
+_FILEID_PLACEHOLDER = "__hymie_fileid__"
+
+#: Returns the data of a form field.
+_field_data = operator.attrgetter("data")
+
+
+@contextlib.contextmanager
+def _locked(lock_file):
+    """Hold an exclusive lock on a file, also against other processes.
+
+    Parameters
+    ----------
+    lock_file : pathlib.Path
+        created if it does not exist.
+    """
+    with open(lock_file, "ab") as fo:
+        if fcntl is not None:
+            fcntl.flock(fo, fcntl.LOCK_EX)
+        # Closing the file releases the lock.
+        yield
+
+
+def _is_recent(folder):
+    """Return True if the folder was modified within _PENDING_FOLDER_TIMEOUT.
+    """
+    try:
+        return time.time() - os.stat(folder).st_mtime < _PENDING_FOLDER_TIMEOUT
+    except OSError:
+        return False
+
+
 def _store(json_file, data):
     """Store dict into a json file in dict.
 
@@ -115,16 +318,40 @@ def _store(json_file, data):
     json_file : pathlib.Path
     data : dict
     """
-    with json_file.open("w", encoding="utf-8") as fo:
-        json.dump(data, fo)
+    _write_bytes(json_file, _json_dumps(data))
+
+
+def _write_bytes(file, content):
+    """Write bytes into a file.
+
+    The content is written to a temporary file in the same folder which then
+    replaces the target atomically, so readers never see a partial file.
+
+    Parameters
+    ----------
+    file : pathlib.Path
+    content : bytes
+    """
+    tmp_file = file.with_name(f"{file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with tmp_file.open("wb") as fo:
+            fo.write(content)
+        os.replace(tmp_file, file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            tmp_file.unlink()
+        raise
 
 
 # {"state": "plan_en_evaluacion", "origin": ["plan_pendiente", "20200527_094911"], "form_dated_file": ["plan", "20200527_095607"]}
-@dataclass
+@dataclass(frozen=True)
 class State:
     """State
     """
 
+    # No instance dict, many of these are created by the state history.
+    __slots__ = ("state", "timestamp", "origin_dated_tuple", "form_dated_tuple")
+
     state: str
 
     #: current timestamp
@@ -168,17 +395,27 @@ class Storage:
 
     Multiple dated files for the same plain endpoint are possible.
 
-    A symlink pointing to the most recent dated file is created for each endpoint.
+    The most recent dated file for each endpoint is recorded in an index
+    (`_latest.json`) within the user folder, which is replaced atomically on
+    each update while holding a lock on `_latest.lock`. Folders created by
+    previous versions used a symlink for each endpoint instead; these are read
+    until the index is first written.
 
     Endpoints controlled by the system are prefixed with an underscore ('_'). Two
     of these exist:
         1. _email: indicates the e-mail address for this hash.
         2. _state: indicates the current state for this user.
 
+    The user folder also contains these system files, which are not endpoints:
+        1. _latest.json: the index of the most recent dated files.
+        2. _latest.lock: locked while updating the index.
+        3. _email.txt: the e-mail address as plain text, to find registered
+           users without reading the json files.
+
     For a large base of active users database backend is suggested.
     """
 
-    def __init__(self, path, salt):
+    def __init__(self, path, salt, kdf_iterations=None):
 
         #: Root path for the storage backend.
         self.path = pathlib.Path(path)
@@ -193,7 +430,8 @@ class Storage:
         self.archived_path.mkdir(parents=True, exist_ok=True)
 
         salt_file = self.path.joinpath("salt.txt")
-        if salt_file.exists():
+        is_new = not salt_file.exists()
+        if not is_new:
             if salt_file.read_text(encoding="utf-8") != salt:
                 raise Exception(
                     "The salt value for the current storage does not match the provided value."
@@ -201,6 +439,28 @@ class Storage:
         else:
             salt_file.write_text(salt, encoding="utf-8")
 
+        iterations_file = self.path.joinpath(KDF_ITERATIONS_FILE)
+        if iterations_file.exists():
+            stored = int(iterations_file.read_text(encoding="utf-8"))
+            if kdf_iterations is not None and kdf_iterations != stored:
+                raise Exception(
+                    f"The storage uses {stored} kdf iterations, "
+                    f"migrate it to use {kdf_iterations}."
+                )
+            kdf_iterations = stored
+        elif is_new:
+            if kdf_iterations is None:
+                kdf_iterations = DEFAULT_KDF_ITERATIONS
+            iterations_file.write_text(str(kdf_iterations), encoding="utf-8")
+        elif kdf_iterations is None or kdf_iterations == LEGACY_KDF_ITERATIONS:
+            # Created before the number of iterations was configurable.
+            kdf_iterations = LEGACY_KDF_ITERATIONS
+        else:
+            raise Exception(
+                f"The storage uses {LEGACY_KDF_ITERATIONS} kdf iterations, "
+                f"migrate it to use {kdf_iterations}."
+            )
+
         # We create an empty file just to see that we have write privileges
         # to these folders
         self.path.joinpath("ok").touch(exist_ok=True)
@@ -209,26 +469,92 @@ class Storage:
         #: User defined salt to hash the e-mail.
         self.salt = salt.encode("utf-8")
 
-        self.upload_set = UploadSet("files", ("pdf",))
+        #: Number of PBKDF2 iterations to hash the e-mail.
+        self.kdf_iterations = kdf_iterations
+
+        #: e-mail -> uid and uid -> e-mail caches. The first one is large
+        #: so that a worker derives the uid once per e-mail (see hash_for).
+        self._hash_cache = TinyLFUCache(65536)
+        self._email_cache = TinyLFUCache(1024)
+
+        #: uid -> user folder cache.
+        self._folder_cache = TinyLFUCache(1024)
+
+        #: folder -> (index file stat, endpoint -> most recent dated file name)
+        self._latest_cache = TinyLFUCache(1024)
+        self._latest_lock = threading.Lock()
+
+        #: dated file -> (file stat, content)
+        self._content_cache = TinyLFUCache(1024)
+
+        #: form class -> serialization plan (see _form_plan)
+        self._form_plans = {}
+
+        #: (migration file stat, old uid -> new uid), see migrated_uid.
+        self._migrated = None
+
+        #: Set of uploaded files (see upload_set).
+        self._upload_set = None
 
-    @functools.lru_cache(maxsize=512)
+        #: e-mail -> uid of registered users, filled lazily from the user folders.
+        self._registered = {}
+        self._scanned_uids = set()
+        self._pending_uids = set()
+        self._scanned_mtime = None
+        self._scanned_lock = threading.Lock()
+
+    @property
+    def upload_set(self):
+        """Set of uploaded files, created on first use.
+        """
+        if self._upload_set is None:
+            from flask_uploads import UploadSet
+
+            self._upload_set = UploadSet("files", ("pdf",))
+        return self._upload_set
+
+    # The uid is the name of the user folder and is part of the links sent
+    # by e-mail, therefore the derivation cannot change without a migration
+    # (see migrate_kdf_iterations).
     def hash_for(self, email):
         """Return unique hash for a given e-mail
         """
-        return hashlib.pbkdf2_hmac(
-            "sha256", email.encode("utf-8"), self.salt, 100000,
-        ).hex()
+        try:
+            return self._hash_cache[email]
+        except KeyError:
+            pass
+
+        # The user folders already map the e-mail of registered users to
+        # their uid, PBKDF2 is only needed for the rest.
+        self._scan_registered()
+        uid = self._registered.get(email)
+        if uid is None:
+            uid = hashlib.pbkdf2_hmac(
+                "sha256", email.encode("utf-8"), self.salt, self.kdf_iterations,
+            ).hex()
+        self._hash_cache[email] = uid
+        return uid
 
     def statehash_for(self, uid):
         """Return the current state hash for user.
         """
-        fn = self.path.joinpath(uid, "_state").with_suffix(".json").resolve().stem
-        return self.hash_for(uid + fn)
+        # An unknown user gets a hash that does not match any state.
+        dated_name = self._load_latest(self._folder(uid)).get("_state", "_state.json")
+        return self._token_for(uid + dated_name[:-5])
+
+    def _token_for(self, data):
+        """Return a keyed hash for data to be used in links.
+
+        Unlike the uid, these tokens do not need a slow key derivation.
+        """
+        return hashlib.blake2b(
+            data.encode("utf-8"), key=self.salt[:64], digest_size=32
+        ).hexdigest()
 
     def folder_for(self, email):
         """Return the folder a user given the e-mail.
         """
-        return self.path.joinpath(self.hash_for(email))
+        return self._folder(self.hash_for(email))
 
     def register(self, email, first_state):
         """Register an e-mail in the system.
@@ -241,18 +567,158 @@ class Storage:
 
         Returns
         -------
-        pathlib.Path, pathlib.Path
-            link file and dated file for the email storage.s
+        pathlib.Path
+            dated file for the first state.
         """
         folder = self.folder_for(email)
         folder.mkdir()
         self.user_store(folder, "_email", dict(email=email))
+        _write_bytes(folder.joinpath(EMAIL_FILE), email.encode("utf-8"))
+        with self._scanned_lock:
+            self._registered[email] = folder.name
+            self._scanned_uids.add(folder.name)
         return self.user_store_state(folder, first_state)
 
     def is_registered(self, email):
         """Return True if the email is registered in the system.
         """
-        return self.folder_for(email).exists()
+        # Unknown e-mails are rejected without deriving the uid.
+        self._scan_registered()
+        uid = self._registered.get(email)
+        if uid is None:
+            return False
+        return self._folder(uid).exists()
+
+    def _scan_registered(self):
+        """Record the e-mail and uid of new user folders.
+
+        The root folder is only scanned if its modification time has changed,
+        which happens when a user folder is created (by any process). Folders
+        still being created are checked again on each call.
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._scanned_mtime and not self._pending_uids:
+            return
+
+        with self._scanned_lock:
+            if mtime == self._scanned_mtime:
+                uids = tuple(self._pending_uids)
+            else:
+                uids = self.yield_uids()
+
+            for uid in uids:
+                if uid in self._scanned_uids:
+                    continue
+                folder = self._folder(uid)
+                try:
+                    email = self._read_email(folder)
+                except FileNotFoundError:
+                    if _is_recent(folder):
+                        # Being created by register.
+                        self._pending_uids.add(uid)
+                        continue
+                    logger.warning(f"No e-mail found in {folder}, folder ignored.")
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Could not read e-mail in {folder}: {e}")
+                else:
+                    self._registered[email] = uid
+                self._pending_uids.discard(uid)
+                self._scanned_uids.add(uid)
+
+            # On filesystems with coarse timestamps, a folder created within the
+            # same tick as the last scan would not change the modification time.
+            if time.time_ns() - mtime > _MTIME_RESOLUTION_NS:
+                self._scanned_mtime = mtime
+            else:
+                self._scanned_mtime = None
+
+    def migrate_kdf_iterations(self, kdf_iterations):
+        """Rename all user folders to the uid derived with a new number of
+        PBKDF2 iterations.
+
+        The renames are recorded in `kdf_migration.json` (old uid -> new uid)
+        to resolve links sent before the migration (see migrated_uid). Archived
+        folders are not renamed and keep the old uid. No other process should
+        use the storage while migrating.
+
+        Parameters
+        ----------
+        kdf_iterations : int
+
+        Returns
+        -------
+        dict
+            old uid -> new uid
+        """
+        renames = {}
+        for uid in list(self.yield_uids()):
+            email = self._read_email(self._folder(uid))
+            new_uid = hashlib.pbkdf2_hmac(
+                "sha256", email.encode("utf-8"), self.salt, kdf_iterations,
+            ).hex()
+            if new_uid != uid:
+                renames[uid] = new_uid
+
+        migration_file = self.path.joinpath(KDF_MIGRATION_FILE)
+        if migration_file.exists():
+            previous = _json_loads(migration_file.read_bytes())
+            # Links older than the previous migration.
+            previous = {k: renames.get(v, v) for k, v in previous.items()}
+        else:
+            previous = {}
+        _store(migration_file, {**previous, **renames})
+
+        for uid, new_uid in renames.items():
+            os.rename(self._folder(uid), self._folder(new_uid))
+
+        _write_bytes(
+            self.path.joinpath(KDF_ITERATIONS_FILE),
+            str(kdf_iterations).encode("utf-8"),
+        )
+        self.kdf_iterations = kdf_iterations
+
+        for cache in (
+            self._hash_cache,
+            self._email_cache,
+            self._folder_cache,
+            self._latest_cache,
+            self._content_cache,
+        ):
+            cache.clear()
+        with self._scanned_lock:
+            self._registered.clear()
+            self._scanned_uids.clear()
+            self._pending_uids.clear()
+            self._scanned_mtime = None
+
+        return renames
+
+    def migrated_uid(self, uid):
+        """Return the uid that a user folder was renamed to by
+        migrate_kdf_iterations, or None if it was not.
+
+        Parameters
+        ----------
+        uid : str
+
+        Returns
+        -------
+        str or None
+        """
+        migration_file = self.path.joinpath(KDF_MIGRATION_FILE)
+        try:
+            st = os.stat(migration_file)
+        except FileNotFoundError:
+            return None
+
+        # The file has an entry per migrated user, it is only parsed again
+        # if it has been replaced.
+        stamp = st.st_ino, st.st_mtime_ns, st.st_size
+        migrated = self._migrated
+        if migrated is None or migrated[0] != stamp:
+            with open(migration_file, "rb") as fi:
+                migrated = self._migrated = stamp, _json_loads(fi.read())
+        return migrated[1].get(uid)
 
     def archive(self, uid):
         dst = self.archived_path.joinpath(uid)
@@ -266,14 +732,17 @@ class Storage:
     def yield_uids(self):
         """Yield all uid.
         """
-        for f in self.path.iterdir():
-            if not f.is_dir():
-                continue
-            if f.stem not in ("uploads", "archived", "_server"):
-                yield f.stem
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name in ("uploads", "archived", "_server"):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.name
 
     def retrieve_scheduled_emails(self):
-        return _retrieve(self.path.joinpath("cron.json"))
+        # Not a dated file, read as it is.
+        with open(self.path.joinpath("cron.json"), "rb") as fi:
+            return _json_loads(fi.read())
 
     def store_scheduled_emails(self, cron):
         return _store(self.path.joinpath("cron.json"), cron)
@@ -282,7 +751,112 @@ class Storage:
     # Methods to access information of a specific user
     ####################################################
 
-    @functools.lru_cache(maxsize=512)
+    def _folder(self, uid):
+        if isinstance(uid, pathlib.Path):
+            return uid
+        try:
+            return self._folder_cache[uid]
+        except KeyError:
+            pass
+
+        folder = self.path.joinpath(uid)
+        self._folder_cache[uid] = folder
+        return folder
+
+    def _load_latest(self, folder):
+        """Return the most recent dated file name for each endpoint of a user.
+
+        The index is cached and only read again if the file has changed.
+
+        Parameters
+        ----------
+        folder : pathlib.Path
+
+        Returns
+        -------
+        dict
+            endpoint -> dated file name (must not be modified)
+        """
+        index_file = folder.joinpath(LATEST_INDEX)
+        try:
+            st = os.stat(index_file)
+        except FileNotFoundError:
+            return self._latest_from_links(folder)
+
+        # The index is always replaced, so a new inode means new content.
+        stamp = st.st_ino, st.st_mtime_ns, st.st_size
+        key = str(folder)
+        cached = self._latest_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        with open(index_file, "rb") as fi:
+            latest = _json_loads(fi.read())
+
+        self._latest_cache[key] = stamp, latest
+        return latest
+
+    @staticmethod
+    def _latest_from_links(folder):
+        """Build the index from the symlinks used by previous versions.
+        """
+        latest = {}
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    name = entry.name
+                    if name.endswith(".json") and entry.is_symlink():
+                        latest[name[:-5]] = os.path.basename(os.readlink(entry.path))
+        except FileNotFoundError:
+            pass
+        return latest
+
+    def _retrieve_cached(self, json_file, endpoint_timestamp=None):
+        """Read json file from disk into dict, reusing the cached content if
+        the file has not changed.
+
+        Parameters
+        ----------
+        json_file : str or pathlib.Path
+            dated file (not a link).
+        endpoint_timestamp : (str, str) or None
+            endpoint and timestamp of the file, if already known.
+
+        Returns
+        -------
+        dict
+            a shallow copy of the content.
+        """
+        key = os.fspath(json_file)
+        st = os.stat(key)
+        stamp = st.st_ino, st.st_mtime_ns, st.st_size
+
+        cached = self._content_cache.get(key)
+        if cached is None or cached[0] != stamp:
+            if endpoint_timestamp is None:
+                endpoint_timestamp = _split_dated_name(os.path.basename(key))
+            cached = stamp, _retrieve(key, endpoint_timestamp)
+            self._content_cache[key] = cached
+
+        return dict(cached[1])
+
+    def _update_latest(self, folder, entries):
+        """Record new dated files as the most recent for their endpoints.
+
+        Parameters
+        ----------
+        folder : pathlib.Path
+        entries : dict
+            endpoint -> dated file name
+        """
+        # The index is read and written under a lock shared with other
+        # processes, otherwise concurrent updates of different endpoints
+        # would overwrite each other.
+        with self._latest_lock, _locked(folder.joinpath(LATEST_LOCK)):
+            latest = dict(self._load_latest(folder))
+            latest.update(entries)
+            _store(folder.joinpath(LATEST_INDEX), latest)
+
     def user_retrieve_email(self, uid):
         """Retrieve e-mail for uid.
 
@@ -294,7 +868,22 @@ class Storage:
         -------
         str
         """
-        return self.user_retrieve(uid, "_email")["email"]
+        try:
+            return self._email_cache[uid]
+        except KeyError:
+            pass
+
+        email = self._read_email(self._folder(uid))
+        self._email_cache[uid] = email
+        return email
+
+    def _read_email(self, folder):
+        try:
+            with open(_file_in(folder, EMAIL_FILE), "rb") as fi:
+                return fi.read().decode("utf-8")
+        except FileNotFoundError:
+            # Registered before the plain text file was introduced.
+            return self.user_retrieve(folder, "_email")["email"]
 
     def user_retrieve_state(self, uid):
         """Retrieve current state for uid.
@@ -310,7 +899,7 @@ class Storage:
 
         return State.from_hymie_dict(self.user_retrieve(uid, "_state"))
 
-    def user_store(self, uid, endpoint, data, make_link_file=True):
+    def user_store(self, uid, endpoint, data, make_current=True):
         """Store data for a given user.
 `
         Parameters
@@ -320,61 +909,57 @@ class Storage:
             plain endpoint name
         data : dict
             content to store
-        make_link_file : bool
-            if True, a link file will be created.
+        make_current : bool
+            if True, the dated file is recorded as the most recent for the endpoint.
 
         Returns
         -------
-        pathlib.Path, pathlib.Path
-            link file and dated file
+        pathlib.Path
+            dated file
         """
-        if isinstance(uid, pathlib.Path):
-            folder = uid
-        else:
-            folder = self.path.joinpath(uid)
+        folder = self._folder(uid)
 
-        dated_file = folder.joinpath(
-            endpoint + "_" + datetime_to_timestamp()
-        ).with_suffix(".json")
+        dated_file = folder.joinpath(f"{endpoint}_{datetime_to_timestamp()}.json")
 
         _store(dated_file, data)
+        self._content_cache.pop(os.fspath(dated_file))
 
-        link_file = folder.joinpath(endpoint).with_suffix(".json")
-
-        if make_link_file:
-            if link_file.exists():
-                link_file.unlink()
+        if make_current:
+            self._update_latest(folder, {endpoint: dated_file.name})
 
-            link_file.symlink_to(dated_file.relative_to(link_file.parent))
+        return dated_file
 
-        return link_file, dated_file
-
-    def user_store_state(self, uid, state, make_link_file=True, form_dated_tuple=None):
+    def user_store_state(self, uid, state, make_current=True, form_dated_tuple=None):
         """Store a new state for given user.
 
         Parameters
         ----------
         uid : str
         state : str
-        make_link_file : bool
-            if True,
+        make_current : bool
+            if True, the dated file is recorded as the current state.
 
         Returns
         -------
-        pathlib.Path, pathlib.Path
-            link file and dated file
+        pathlib.Path
+            dated file
         """
         try:
             current_state = self.user_retrieve_state(uid)
             origin = current_state.state, current_state.timestamp
         except FileNotFoundError:
-            origin = "register", datetime_to_timestamp(arrow.now().shift(minutes=-1))
+            origin = (
+                "register",
+                datetime_to_timestamp(
+                    datetime.datetime.now() - datetime.timedelta(minutes=1)
+                ),
+            )
 
         return self.user_store(
             uid,
             "_state",
             dict(state=state, origin=origin, form_dated_tuple=form_dated_tuple),
-            make_link_file=make_link_file,
+            make_current=make_current,
         )
 
     def user_retrieve(self, uid, endpoint):
@@ -391,21 +976,22 @@ class Storage:
         -------
         dict
         """
-        file = self.path.joinpath(uid, endpoint).with_suffix(".json")
-        return _retrieve(file)
+        folder = self._folder(uid)
+        dated_name = self._load_latest(folder).get(endpoint)
+        if dated_name is None:
+            # A dated endpoint.
+            return self._retrieve_cached(_file_in(folder, endpoint + ".json"))
+        return self._retrieve_cached(
+            _file_in(folder, dated_name), _split_dated_name(dated_name)
+        )
 
     def user_retrieve_form_data(self, uid, endpoint, form_cls):
         data = self.user_retrieve(uid, endpoint)
-        # noinspection PyProtectedMember
-        for name, value in data.items():
-            field = getattr(form_cls, name, None)
-            if field is None:
-                continue
-            field_type = field.__dict__["field_class"].__name__
-            if field_type == "DateField":
-                data[name] = arrow.get(value, "DD/MM/YY").datetime
-            elif field_type == "TimeField":
-                data[name] = arrow.get(value, "HH:mm").datetime
+        for name, fmt in _parse_formats(form_cls).items():
+            if name in data:
+                data[name] = datetime.datetime.strptime(data[name], fmt).replace(
+                    tzinfo=datetime.timezone.utc
+                )
 
         return data
 
@@ -423,18 +1009,15 @@ class Storage:
         dict
             endpoint -> content
         """
-        out = {}
-        for p in self.path.joinpath(uid).iterdir():
-            if p.is_dir():
-                continue
-            if not p.is_symlink():
-                continue
-            endpoint = p.stem
-            if endpoint not in endpoints:
-                continue
-
-            out[endpoint] = _retrieve(p)
-        return out
+        folder = self._folder(uid)
+        return _retrieve_dated(
+            folder,
+            {
+                endpoint: dated_name
+                for endpoint, dated_name in self._load_latest(folder).items()
+                if endpoint in endpoints
+            },
+        )
 
     def user_retrieve_all_current(self, uid, skip=()):
         """Retrieve the content of all non-system endpoints at the most recent dates.
@@ -450,27 +1033,24 @@ class Storage:
         dict
             endpoint -> content
         """
-        out = {}
-        for p in self.path.joinpath(uid).iterdir():
-            if p.is_dir():
-                continue
-            if not p.is_symlink():
-                continue
-            endpoint = p.stem
-            if endpoint.startswith("_"):
-                continue
-            if endpoint in skip:
-                continue
-
-            out[endpoint] = _retrieve(p)
-        return out
+        folder = self._folder(uid)
+        return _retrieve_dated(
+            folder,
+            {
+                endpoint: dated_name
+                for endpoint, dated_name in self._load_latest(folder).items()
+                if not endpoint.startswith("_") and endpoint not in skip
+            },
+        )
 
-    def user_retrieve_index(self, uid):
+    def user_retrieve_index(self, uid, limit=None):
         """Retrieve a list of all non-system dated endpoints.
 
         Parameters
         ----------
         uid : str
+        limit : int or None
+            if given, only the most recent dated endpoints are retrieved.
 
         Returns
         -------
@@ -478,18 +1058,25 @@ class Storage:
             tuple of timestamp, plain endpoint ordered by timestamp.
         """
         out = {}
-        for p in self.path.joinpath(uid).iterdir():
-            if p.is_dir() or p.is_symlink():
-                continue
-
-            if p.stem.startswith("_"):
-                continue
+        # Endpoint and timestamp are parsed from the names of the dated files,
+        # the entries carry the file type so no extra stat is needed.
+        with os.scandir(self._folder(uid)) as it:
+            for entry in it:
+                name = entry.name
+                if name.startswith("_") or not name.endswith(".json"):
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
 
-            endpoint, timestamp = split_endpoint_timestamp(p)
+                endpoint, timestamp = _split_dated_name(name)
 
-            out[timestamp] = endpoint
+                out[timestamp] = endpoint
 
-        return tuple((k, out[k]) for k in sorted(out.keys()))
+        if limit is None:
+            keys = sorted(out.keys())
+        else:
+            keys = reversed(heapq.nlargest(limit, out.keys()))
+        return tuple((k, out[k]) for k in keys)
 
     def user_retrieve_state_history(self, uid):
         """Retrieve the state history.
@@ -504,13 +1091,16 @@ class Storage:
             timestamp -> state, form_dated_file
         """
         out = {}
-        for p in self.path.joinpath(uid).iterdir():
-            if p.is_dir() or p.is_symlink():
-                continue
-            if not p.stem.startswith("_state"):
-                continue
-            content = self.user_retrieve(uid, p.stem)
-            out[content["_hymie_timestamp"]] = State.from_hymie_dict(content)
+        with os.scandir(self._folder(uid)) as it:
+            for entry in it:
+                name = entry.name
+                if not name.startswith("_state_") or not name.endswith(".json"):
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                endpoint_timestamp = _split_dated_name(name)
+                content = _retrieve(entry.path, endpoint_timestamp)
+                out[endpoint_timestamp[1]] = State.from_hymie_dict(content)
 
         return out
 
@@ -535,35 +1125,33 @@ class Storage:
         else:
 
             dated_file = None
-            form_link_file = None
             form_dated_file = None
 
             try:
                 if store_form:
                     form_name, json_form = store_form
-                    form_link_file, form_dated_file = self.user_store(
-                        uid, form_name, json_form, make_link_file=False
+                    form_dated_file = self.user_store(
+                        uid, form_name, json_form, make_current=False
                     )
 
-                last_file, dated_file = self.user_store_state(
+                dated_file = self.user_store_state(
                     uid,
                     state,
-                    make_link_file=False,
-                    form_dated_tuple=split_endpoint_timestamp(form_dated_file),
+                    make_current=False,
+                    form_dated_tuple=(
+                        _split_dated_name(form_dated_file.name)
+                        if form_dated_file
+                        else None
+                    ),
                 )
 
-                yield self.hash_for(uid + dated_file.stem)
-
-                if last_file.exists():
-                    last_file.unlink()
+                yield self._token_for(uid + dated_file.stem)
 
+                # The form and the state are updated together.
+                latest = {"_state": dated_file.name}
                 if form_dated_file:
-                    if form_link_file.exists():
-                        form_link_file.unlink()
-
-                    form_link_file.symlink_to(form_dated_file)
-
-                last_file.symlink_to(dated_file)
+                    latest[form_name] = form_dated_file.name
+                self._update_latest(self._folder(uid), latest)
 
             except Exception:
                 if form_dated_file:
@@ -587,8 +1175,8 @@ class Storage:
 
         Returns
         -------
-        pathlib.Path, pathlib.Path
-            link file and dated file
+        pathlib.Path
+            dated file
         """
         data = self.form_to_dict(form)
         return self.user_store(uid, endpoint, data)
@@ -608,6 +1196,16 @@ class Storage:
         filename = self.upload_set.save(field)
         return self.upload_set.url(filename)
 
+    #: Fields of a form that are not stored.
+    _SKIP_FIELDS = frozenset(("csrf_token", "submit"))
+
+    #: Field type -> function to serialize the data of such field.
+    #: Fields not listed here are stored as they are.
+    _FIELD_HANDLERS = {
+        "DateField": lambda field: field.data.strftime("%d/%m/%y"),
+        "TimeField": lambda field: field.data.strftime("%H:%M"),
+    }
+
     def form_to_dict(self, form):
         """Convert a form to a dict.
 
@@ -621,22 +1219,54 @@ class Storage:
         -------
         dict
         """
-        data = {}
+        form_cls = type(form)
+        try:
+            plan = self._form_plans[form_cls]
+        except KeyError:
+            plan = self._form_plan(form)
+            self._form_plans[form_cls] = plan
+
+        fields = form._fields
+        return {name: serialize(fields[name]) for name, serialize in plan}
+
+    def _form_plan(self, form):
+        """Return how to serialize each field of a form.
+
+        The fields of all instances of a form class are the same,
+        so the plan is computed once for each class.
+
+        Parameters
+        ----------
+        form : FlaskForm
+
+        Returns
+        -------
+        tuple of (str, callable)
+            field name, function taking the field and returning its value.
+        """
+        handlers = self._FIELD_HANDLERS
+        plan = []
         # noinspection PyProtectedMember
         for name, field in form._fields.items():
-            if name in ("csrf_token", "submit"):
+            if name in self._SKIP_FIELDS:
                 continue
             if field.type == "FileField":
-                if field.data is None:
-                    data[name] = None
-                    continue
-                fileid = self.upload_set.save(field.data)
-                data[name] = url_for("file", fileid=fileid, _external=True)
-            elif field.type == "DateField":
-                data[name] = field.data.strftime("%d/%m/%y")
-            elif field.type == "TimeField":
-                data[name] = field.data.strftime("%H:%M")
+                plan.append((name, self._save_file_field))
             else:
-                data[name] = field.data
+                plan.append((name, handlers.get(field.type, _field_data)))
+        return tuple(plan)
 
-        return data
+    def _save_file_field(self, field):
+        if field.data is None:
+            return None
+        fileid = self.upload_set.save(field.data)
+
+        # The url only changes in the fileid, it is built once per request.
+        # (fileids are secure filenames, no quoting needed)
+        try:
+            url = g.hymie_file_url
+        except AttributeError:
+            url = g.hymie_file_url = url_for(
+                "file", fileid=_FILEID_PLACEHOLDER, _external=True
+            )
+        return url.replace(_FILEID_PLACEHOLDER, fileid)
@@ -0,0 +1,39 @@
+import pytest
+
+from hymie.cache import TinyLFUCache
+
+
+def test_get_set():
+    cache = TinyLFUCache(4)
+    with pytest.raises(KeyError):
+        cache["a"]
+    cache["a"] = 1
+    assert cache["a"] == 1
+    assert "a" in cache
+    assert cache.get("b") is None
+    assert cache.pop("a") == 1
+    assert "a" not in cache
+
+
+def test_bounded():
+    cache = TinyLFUCache(8)
+    for n in range(100):
+        cache.get(n)
+        cache[n] = n
+    assert len(cache) == 8
+
+
+def test_scan_resistant():
+    cache = TinyLFUCache(8)
+    hot = list(range(8))
+    for _ in range(3):
+        for key in hot:
+            if cache.get(key) is None:
+                cache[key] = key
+
+    # A scan over keys that are requested only once.
+    for key in range(100, 200):
+        if cache.get(key) is None:
+            cache[key] = key
+
+    assert all(key in cache for key in hot)
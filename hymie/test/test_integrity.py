@@ -0,0 +1,104 @@
+import pytest
+
+from hymie import hymie
+from hymie.app import create_app
+from hymie.hymie import Hymie
+
+HYMIE_YAML = """
+metadata:
+  name: Test
+  description: Test app
+  maintainer: Someone
+  maintainer_email: some@example.com
+  first_state: {first_state}
+config:
+  email:
+    address: app@example.com
+    host: localhost
+    port: 25
+    use_tls: false
+    use_ssl: false
+    user: u
+    password: p
+    timeout: 10
+    subject: "[Test]"
+    debug: true
+  secret:
+    key: abc
+    admin_password: pw
+  storage:
+    path: {storage}
+    salt: salt
+states:
+  start:
+    description: Start
+    page_template: start.md
+forms: {{}}
+"""
+
+
+def write_app(path, first_state="start"):
+    path.joinpath("hymie.yaml").write_text(
+        HYMIE_YAML.format(first_state=first_state, storage=path.joinpath("storage"))
+    )
+    path.joinpath("pages").mkdir(exist_ok=True)
+    path.joinpath("pages", "start.md").write_text("title: Start\n\nHello")
+
+
+@pytest.fixture
+def checks(monkeypatch):
+    """List with an item for each complete integrity check.
+    """
+    out = []
+    integrity_page_check = Hymie.integrity_page_check
+
+    def counting_page_check(self, *args, **kwargs):
+        out.append(args)
+        return integrity_page_check(self, *args, **kwargs)
+
+    monkeypatch.setattr(Hymie, "integrity_page_check", counting_page_check)
+    return out
+
+
+def test_skipped_if_unchanged(tmp_path, checks):
+    write_app(tmp_path)
+    create_app(tmp_path)
+    assert len(checks) == 1
+    create_app(tmp_path)
+    assert len(checks) == 1
+
+
+def test_template_changed(tmp_path, checks):
+    write_app(tmp_path)
+    create_app(tmp_path)
+    tmp_path.joinpath("pages", "start.md").write_text("title: Start\n\nBye")
+    create_app(tmp_path)
+    assert len(checks) == 2
+    create_app(tmp_path)
+    assert len(checks) == 2
+
+
+def test_dependency_changed(tmp_path, checks, monkeypatch):
+    write_app(tmp_path)
+    create_app(tmp_path)
+    monkeypatch.setattr(hymie.jinja2, "__version__", "0.0", raising=False)
+    create_app(tmp_path)
+    assert len(checks) == 2
+
+
+def test_failed_not_cached(tmp_path, checks):
+    write_app(tmp_path, first_state="missing")
+    with pytest.raises(Exception, match="Integrity check not passed"):
+        create_app(tmp_path)
+    with pytest.raises(Exception, match="Integrity check not passed"):
+        create_app(tmp_path)
+    assert len(checks) == 2
+
+
+def test_symlink_cycle(tmp_path, checks):
+    write_app(tmp_path)
+    tmp_path.joinpath("pages", "sub").mkdir()
+    tmp_path.joinpath("pages", "sub", "loop").symlink_to("..")
+    create_app(tmp_path)
+    create_app(tmp_path)
+    assert len(checks) == 1
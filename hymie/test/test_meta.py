@@ -0,0 +1,29 @@
+import pytest
+from markdown import Markdown
+
+from hymie.common import split_meta
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "<p>no attributes</p>",
+        "subject: Hello\n\n<p>{{ name }}</p>",
+        "Subject: Hello\nlink_a: done\n\n<p>body</p>\n",
+        "doc: first line\n    second line\n\n<p>body</p>",
+        "---\ntitle: Hello\n---\n<p>body</p>",
+        "title: Hello\n<p>body</p>",
+    ],
+)
+def test_split_meta(text):
+    md = Markdown(extensions=["meta"])
+    md.convert(text)
+    meta, _ = split_meta(text)
+    assert meta == md.Meta
+
+
+def test_split_meta_body():
+    meta, body = split_meta("subject: Hello\n\n<p>{{ name }}</p>")
+    assert meta == {"subject": ["Hello"]}
+    assert body == "<p>{{ name }}</p>"
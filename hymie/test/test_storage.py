@@ -0,0 +1,342 @@
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+import flask
+import pytest
+from flask_wtf import FlaskForm
+from wtforms import StringField, SubmitField
+from wtforms.fields.html5 import DateField
+from wtforms_components import TimeField
+
+from hymie import storage as storage_module
+from hymie.storage import EMAIL_FILE, LATEST_INDEX, Storage
+
+
+class SampleForm(FlaskForm):
+    name = StringField()
+    day = DateField()
+    hour = TimeField()
+    submit = SubmitField()
+
+
+def build_form(**data):
+    """Build a SampleForm in a request posting data.
+    """
+    app = flask.Flask(__name__)
+    app.config["SECRET_KEY"] = "secret"
+    with app.test_request_context(method="POST", data=data):
+        return SampleForm()
+
+
+def test_store_retrieve(tmp_path):
+    storage = Storage(tmp_path, "salt")
+    storage.register("user@example.com", "first")
+    uid = storage.hash_for("user@example.com")
+
+    assert storage.user_retrieve_email(uid) == "user@example.com"
+    assert storage.user_retrieve_state(uid).state == "first"
+
+    dated_file = storage.user_store(uid, "form1", dict(name="Alice"))
+    content = storage.user_retrieve(uid, "form1")
+    assert content["name"] == "Alice"
+    assert content["_hymie_endpoint"] == "form1"
+    assert storage.user_retrieve(uid, dated_file.stem) == content
+    assert storage.user_retrieve_all_current(uid) == dict(form1=content)
+    assert storage.user_retrieve_index(uid) == ((dated_file.stem[-15:], "form1"),)
+    assert storage.user_retrieve_index(uid, limit=0) == ()
+
+
+def test_retrieve_index_limit(tmp_path):
+    storage = Storage(tmp_path, "salt")
+    storage.register("user@example.com", "first")
+    uid = storage.hash_for("user@example.com")
+
+    folder = storage.user_store(uid, "form1", dict(name="Alice")).parent
+    for file in folder.glob("form1_*.json"):
+        file.unlink()
+
+    # Created out of order.
+    timestamps = ("20200103_120000", "20200101_120000", "20200105_120000")
+    timestamps += ("20200102_120000", "20200104_120000")
+    for n, timestamp in enumerate(timestamps):
+        folder.joinpath(f"form{n}_{timestamp}.json").write_text("{}")
+
+    expected = tuple(
+        sorted((timestamp, f"form{n}") for n, timestamp in enumerate(timestamps))
+    )
+    assert storage.user_retrieve_index(uid) == expected
+    for limit in range(1, len(timestamps)):
+        assert storage.user_retrieve_index(uid, limit=limit) == expected[-limit:]
+    assert storage.user_retrieve_index(uid, limit=10) == expected
+
+
+def test_maybe_store_state(tmp_path):
+    storage = Storage(tmp_path, "salt")
+    storage.register("user@example.com", "first")
+    uid = storage.hash_for("user@example.com")
+
+    with storage.maybe_store_state(uid, "second", store_form=("form1", dict(a=1))) as h:
+        pass
+
+    assert storage.statehash_for(uid) == h
+
+    state = storage.user_retrieve_state(uid)
+    assert state.state == "second"
+    assert state.form_dated_tuple[0] == "form1"
+    assert storage.user_retrieve(uid, "form1")["a"] == 1
+
+
+def test_legacy_links(tmp_path):
+    storage = Storage(tmp_path, "salt")
+    uid = "legacy"
+    folder = tmp_path.joinpath(uid)
+    folder.mkdir()
+    folder.joinpath("form1_20200101_101010.json").write_text('{"a": 1}')
+    os.symlink("form1_20200101_101010.json", folder.joinpath("form1.json"))
+
+    content = storage.user_retrieve(uid, "form1")
+    assert content["a"] == 1
+    assert content["_hymie_timestamp"] == "20200101_101010"
+    assert not folder.joinpath(LATEST_INDEX).exists()
+
+    storage.user_store(uid, "form2", dict(b=2))
+    assert folder.joinpath(LATEST_INDEX).exists()
+    assert set(storage.user_retrieve_all_current(uid)) == {"form1", "form2"}
+
+
+def test_retrieve_current_parallel(tmp_path, monkeypatch):
+    storage = Storage(tmp_path, "salt")
+    storage.register("user@example.com", "first")
+    uid = storage.hash_for("user@example.com")
+
+    executor = storage_module._read_executor
+    calls = []
+
+    def counting_map(func, *iterables):
+        calls.append(func)
+        return type(executor).map(executor, func, *iterables)
+
+    monkeypatch.setattr(executor, "map", counting_map)
+
+    endpoints = tuple(f"form{n}" for n in range(storage_module._PARALLEL_READS + 2))
+    for n, endpoint in enumerate(endpoints):
+        storage.user_store(uid, endpoint, dict(n=n))
+
+    current = storage.user_retrieve_all_current(uid)
+    assert calls
+    assert sorted(current) == sorted(endpoints)
+    for n, endpoint in enumerate(endpoints):
+        assert current[endpoint]["n"] == n
+        assert current[endpoint]["_hymie_endpoint"] == endpoint
+
+    calls.clear()
+    some = endpoints[1:]
+    assert storage.user_retrieve_current(uid, some) == {
+        endpoint: current[endpoint] for endpoint in some
+    }
+    assert calls
+
+
+def test_retrieve_cached(tmp_path):
+    storage = Storage(tmp_path, "salt")
+    storage.register("user@example.com", "first")
+    uid = storage.hash_for("user@example.com")
+
+    storage.user_store(uid, "form1", dict(name="Alice"))
+    storage.user_retrieve(uid, "form1")["name"] = "Changed"
+    assert storage.user_retrieve(uid, "form1")["name"] == "Alice"
+
+    # Possibly the same dated file, if stored within the same second.
+    storage.user_store(uid, "form1", dict(name="Bob"))
+    assert storage.user_retrieve(uid, "form1")["name"] == "Bob"
+
+    # Replaced by a file with the same size and modification time.
+    dated_file = storage.user_store(uid, "form1", dict(name="Carl"))
+    assert storage.user_retrieve(uid, "form1")["name"] == "Carl"
+    st = dated_file.stat()
+    tmp_file = dated_file.with_suffix(".tmp")
+    tmp_file.write_text(dated_file.read_text().replace("Carl", "Dave"))
+    os.utime(tmp_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp_file, dated_file)
+    assert storage.user_retrieve(uid, "form1")["name"] == "Dave"
+
+
+def test_is_registered(tmp_path):
+    storage = Storage(tmp_path, "salt")
+    storage.register("user@example.com", "first")
+    assert storage.is_registered("user@example.com")
+    assert not storage.is_registered("other@example.com")
+
+    # Registered by another process.
+    Storage(tmp_path, "salt").register("other@example.com", "first")
+    assert storage.is_registered("other@example.com")
+
+
+def test_migrate_kdf_iterations(tmp_path):
+    storage = Storage(tmp_path, "salt", kdf_iterations=10)
+    storage.register("user@example.com", "first")
+    old_uid = storage.hash_for("user@example.com")
+
+    renames = storage.migrate_kdf_iterations(20)
+    new_uid = storage.hash_for("user@example.com")
+    assert renames == {old_uid: new_uid}
+    assert storage.user_retrieve_state(new_uid).state == "first"
+    assert storage.migrated_uid(old_uid) == new_uid
+    assert storage.migrated_uid(new_uid) is None
+
+    assert Storage(tmp_path, "salt").kdf_iterations == 20
+    with pytest.raises(Exception):
+        Storage(tmp_path, "salt", kdf_iterations=10)
+
+    # The record is only read again after it changes.
+    migrated = storage._migrated
+    assert storage.migrated_uid(old_uid) == new_uid
+    assert storage._migrated is migrated
+
+    renames = storage.migrate_kdf_iterations(30)
+    assert storage.migrated_uid(old_uid) == renames[new_uid]
+    assert storage.migrated_uid(new_uid) == renames[new_uid]
+
+
+def test_maybe_store_state_no_form(tmp_path):
+    storage = Storage(tmp_path, "salt")
+    storage.register("user@example.com", "first")
+    uid = storage.hash_for("user@example.com")
+
+    with storage.maybe_store_state(uid, "second"):
+        pass
+
+    state = storage.user_retrieve_state(uid)
+    assert state.state == "second"
+    assert state.form_dated_tuple is None
+
+
+def test_concurrent_update_latest(tmp_path, monkeypatch):
+    a = Storage(tmp_path, "salt")
+    a.register("user@example.com", "first")
+    uid = a.hash_for("user@example.com")
+    b = Storage(tmp_path, "salt")
+
+    load_latest = Storage._load_latest
+
+    def slow_load_latest(self, folder):
+        latest = load_latest(self, folder)
+        time.sleep(0.2)
+        return latest
+
+    monkeypatch.setattr(Storage, "_load_latest", slow_load_latest)
+
+    # Two instances, as in two worker processes.
+    threads = [
+        threading.Thread(target=storage.user_store, args=(uid, endpoint, {}))
+        for storage, endpoint in ((a, "form1"), (b, "form2"))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    monkeypatch.undo()
+    assert {"_email", "_state", "form1", "form2"} == set(
+        Storage(tmp_path, "salt")._load_latest(tmp_path.joinpath(uid))
+    )
+
+
+def test_is_registered_stray_folders(tmp_path):
+    storage = Storage(tmp_path, "salt")
+    storage.register("user@example.com", "first")
+
+    # Left by a failed registration long ago.
+    stray = tmp_path.joinpath("stray")
+    stray.mkdir()
+    os.utime(stray, (0, 0))
+    # Unreadable e-mail.
+    broken = tmp_path.joinpath("broken")
+    broken.mkdir()
+    broken.joinpath(EMAIL_FILE).write_bytes(b"\xff")
+    # Being registered.
+    pending = tmp_path.joinpath("pending")
+    pending.mkdir()
+
+    assert storage.is_registered("user@example.com")
+    assert not storage.is_registered("other@example.com")
+    assert storage._pending_uids == {"pending"}
+
+    pending.joinpath(EMAIL_FILE).write_text("other@example.com")
+    assert storage.is_registered("other@example.com")
+    assert not storage._pending_uids
+
+
+def test_is_registered_same_mtime(tmp_path):
+    storage = Storage(tmp_path, "salt")
+    st = os.stat(tmp_path)
+    assert not storage.is_registered("user@example.com")
+
+    # Registered by another process within the same mtime tick.
+    Storage(tmp_path, "salt").register("user@example.com", "first")
+    os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert storage.is_registered("user@example.com")
+
+
+def test_hash_for_registered(tmp_path, monkeypatch):
+    Storage(tmp_path, "salt").register("user@example.com", "first")
+    uid = Storage(tmp_path, "salt").hash_for("user@example.com")
+
+    def pbkdf2_hmac(*args):
+        raise AssertionError("PBKDF2 should not be used for registered users")
+
+    # A fresh worker, without a previous is_registered call.
+    storage = Storage(tmp_path, "salt")
+    monkeypatch.setattr(hashlib, "pbkdf2_hmac", pbkdf2_hmac)
+    assert storage.hash_for("user@example.com") == uid
+
+
+def test_form_to_dict(tmp_path):
+    storage = Storage(tmp_path, "salt")
+    form = build_form(name="Alice", day="2020-02-15", hour="13:45")
+    assert "csrf_token" in form._fields
+
+    assert storage.form_to_dict(form) == dict(
+        name="Alice", day="15/02/20", hour="13:45"
+    )
+    plan = storage._form_plans[SampleForm]
+    assert [name for name, _ in plan] == ["name", "day", "hour"]
+
+    # The plan is reused for other instances of the same class.
+    form = build_form(name="Bob", day="1999-12-31", hour="00:05")
+    assert storage.form_to_dict(form) == dict(name="Bob", day="31/12/99", hour="00:05")
+    assert storage._form_plans[SampleForm] is plan
+
+
+@pytest.mark.parametrize(
+    "day,expected_year",
+    [
+        ("2020-02-15", 2020),
+        ("1969-01-01", 1969),
+        ("2068-12-31", 2068),
+        # Two-digit years below 69 are read back in the 2000s.
+        ("1968-12-31", 2068),
+    ],
+)
+def test_form_data_round_trip(tmp_path, day, expected_year):
+    storage = Storage(tmp_path, "salt")
+    storage.register("user@example.com", "first")
+    uid = storage.hash_for("user@example.com")
+
+    form = build_form(name="Alice", day=day, hour="13:45")
+    storage.user_store(uid, "form1", storage.form_to_dict(form))
+    data = storage.user_retrieve_form_data(uid, "form1", SampleForm)
+
+    assert data["name"] == "Alice"
+    expected_day = datetime.datetime.strptime(day, "%Y-%m-%d")
+    assert data["day"] == expected_day.replace(
+        year=expected_year, tzinfo=datetime.timezone.utc
+    )
+    assert data["hour"] == datetime.datetime(
+        1900, 1, 1, 13, 45, tzinfo=datetime.timezone.utc
+    )
+    assert data["day"].tzinfo is datetime.timezone.utc
+    assert data["hour"].tzinfo is datetime.timezone.utc